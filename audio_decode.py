@@ -0,0 +1,68 @@
+"""Декодирование голосовых сообщений и вырезание тишины.
+
+Модуль без побочных эффектов при импорте: его заранее загружает сервер forkserver,
+от которого порождаются процессы пула декодирования. Сами процессы пула при старте
+всё равно импортируют запускаемый скрипт бота (как __mp_main__).
+"""
+from io import BytesIO
+
+import av
+import numpy as np
+
+# Параметры аудио для распознавания
+SAMPLE_RATE = 16000
+
+# Вырезание тишины перед локальным распознаванием
+VAD_FRAME_MS = 30           # длина кадра анализа
+VAD_THRESHOLD_DBFS = -40    # кадры тише порога считаются тишиной
+VAD_MIN_SILENCE_MS = 400    # более короткие паузы внутри речи сохраняем
+VAD_MIN_SPEECH_MS = 500     # если речи меньше — не распознаём вовсе
+
+def decode_ogg_to_pcm(voice_data: bytes) -> bytes:
+    """Декодирование ogg/opus в 16-битный моно PCM без временных файлов"""
+    with av.open(BytesIO(voice_data), format="ogg") as container:
+        stream = container.streams.audio[0]
+        resampler = av.AudioResampler(format="s16", layout="mono", rate=SAMPLE_RATE)
+        
+        # Плоскость кадра может быть выровнена с запасом, поэтому берём
+        # только samples * 2 байт; memoryview избавляет от лишней копии
+        chunks = []
+        for frame in container.decode(stream):
+            for resampled in resampler.resample(frame):
+                chunks.append(memoryview(resampled.planes[0])[:resampled.samples * 2])
+        # Забираем остаток из буфера ресемплера
+        for resampled in resampler.resample(None):
+            chunks.append(memoryview(resampled.planes[0])[:resampled.samples * 2])
+        
+        return b"".join(chunks)
+
+def trim_silence(pcm: bytes) -> bytes:
+    """Удаление длинных пауз из 16-битного моно PCM (по энергии кадров)"""
+    samples = np.frombuffer(pcm, dtype=np.int16)
+    frame_len = SAMPLE_RATE * VAD_FRAME_MS // 1000
+    n_frames = len(samples) // frame_len
+    if n_frames == 0:
+        return b""
+    
+    frames = samples[:n_frames * frame_len].reshape(n_frames, frame_len)
+    rms = np.sqrt(np.mean(frames.astype(np.float32) ** 2, axis=1)) / 32768.0
+    speech = 20 * np.log10(np.maximum(rms, 1e-10)) > VAD_THRESHOLD_DBFS
+    
+    speech_idx = np.flatnonzero(speech)
+    if len(speech_idx) == 0:
+        return b""
+    
+    # Короткие паузы между словами оставляем
+    keep = speech.copy()
+    max_gap = VAD_MIN_SILENCE_MS // VAD_FRAME_MS
+    for start, gap in zip(speech_idx[:-1], np.diff(speech_idx)):
+        if 1 < gap <= max_gap:
+            keep[start:start + gap] = True
+    
+    if keep.sum() * VAD_FRAME_MS < VAD_MIN_SPEECH_MS:
+        return b""
+    return frames[keep].tobytes()
+
+def decode_and_trim(voice_data: bytes) -> bytes:
+    """Декодирование и вырезание тишины (выполняется в пуле процессов)"""
+    return trim_silence(decode_ogg_to_pcm(voice_data))
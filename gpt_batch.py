@@ -0,0 +1,258 @@
+"""Отложенная обработка идей через OpenAI Batch API (/later), общая для обоих ботов.
+
+Отправка сообщений пользователю остаётся за ботом: он передаёт колбэки deliver
+(ответ GPT или None при ошибке; False — временная ошибка, повторить позже)
+и notify_failure (идея не обработана).
+"""
+import asyncio
+import logging
+import os
+import time
+
+import orjson
+from openai import NotFoundError
+
+logger = logging.getLogger(__name__)
+
+BATCH_INTERVAL = 300                # как часто отправлять накопленное и проверять готовность, сек
+BATCH_RESUME_WINDOW = 2 * 24 * 3600 # какие задания восстанавливать после перезапуска, сек
+
+def load_state(path):
+    """Чтение сохранённых запросов batch-заданий (batch_id -> {custom_id: запрос})"""
+    try:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    except FileNotFoundError:
+        return {}
+    except (OSError, orjson.JSONDecodeError) as e:
+        logger.warning("Не удалось прочитать %s: %s", path, e)
+        return {}
+
+def save_state(path, data):
+    """Атомарная запись запросов batch-заданий на диск"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def make_custom_id(chat_id, user_id, message_id, username):
+    """custom_id с данными для доставки ответа: по нему задание восстанавливается и после перезапуска"""
+    return f"{chat_id}_{user_id}_{message_id}_{username}"
+
+def item_from_custom_id(custom_id):
+    """Данные для доставки ответа из custom_id (исходного текста в нём нет)"""
+    chat_id, user_id, _, username = custom_id.split("_", 3)
+    return {
+        "custom_id": custom_id,
+        "chat_id": int(chat_id),
+        "username": username,
+        "user_id": int(user_id) if user_id != "None" else None,
+        "text": ""
+    }
+
+class GptBatchQueue:
+    """Очередь /later: накопление запросов, отправка заданиями и рассылка готовых ответов"""
+
+    def __init__(self, openai_client, *, source, model, system_msg, max_tokens,
+                 deliver, notify_failure, state_file, max_input_chars=None):
+        self.openai_client = openai_client
+        self.source = source                # метка заданий бота в metadata
+        self.model = model
+        self.system_msg = system_msg
+        self.max_tokens = max_tokens
+        self.max_input_chars = max_input_chars
+        self.deliver = deliver
+        self.notify_failure = notify_failure
+        self.state_file = state_file
+
+        # Ещё не отправленные запросы и уже отправленные задания
+        # (batch_id -> {custom_id: запрос}; None — запросы известны только по custom_id)
+        self.queue = []
+        self.batches = {}
+        self._saved = None                  # последнее записанное на диск состояние
+
+    def add(self, item):
+        """Постановка запроса в очередь (item: custom_id, chat_id, username, user_id, text)"""
+        self.queue.append(item)
+
+    async def run(self):
+        """Фоновая отправка накопленных запросов и сбор готовых ответов"""
+        resumed = False
+        while True:
+            # Восстановление повторяем, пока оно не пройдёт для всех заданий
+            if not resumed:
+                try:
+                    resumed = await self.resume()
+                except Exception as e:
+                    logger.error("Ошибка восстановления batch-заданий: %s", e)
+            try:
+                await self.submit()
+                await self.collect()
+            except Exception as e:
+                logger.error("Ошибка обработки batch-заданий: %s", e)
+            await asyncio.sleep(BATCH_INTERVAL)
+
+    async def shutdown(self):
+        """Отправка накопленного при остановке — ответы заберёт следующий запуск"""
+        try:
+            await self.submit()
+        except Exception as e:
+            logger.error("Не удалось отправить отложенные запросы при остановке: %s", e)
+        await self.save()
+
+    async def submit(self):
+        """Загрузка накопленных запросов в OpenAI одним batch-заданием"""
+        if not self.queue:
+            return
+
+        items, self.queue = self.queue, []
+        lines = [
+            orjson.dumps({
+                "custom_id": item["custom_id"],
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": self.model,
+                    "messages": [
+                        self.system_msg,
+                        {"role": "user", "content": item["text"][:self.max_input_chars]}
+                    ],
+                    "max_tokens": self.max_tokens,
+                    "temperature": 0.7
+                }
+            })
+            for item in items
+        ]
+
+        submitted = False
+        try:
+            batch_file = await self.openai_client.files.create(
+                file=("batch.jsonl", b"\n".join(lines)),
+                purpose="batch"
+            )
+            batch = await self.openai_client.batches.create(
+                input_file_id=batch_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h",
+                metadata={"source": self.source}
+            )
+            submitted = True
+        finally:
+            # Ошибка или отмена (остановка бота) — вернём запросы в очередь до следующей попытки
+            if not submitted:
+                self.queue = items + self.queue
+
+        self.batches[batch.id] = {item["custom_id"]: item for item in items}
+        logger.info("Batch %s отправлен в OpenAI: %s запросов", batch.id, len(items))
+        await self.save()
+
+    async def save(self):
+        """Сохранение запросов отправленных заданий, если они изменились"""
+        data = orjson.dumps(self.batches)
+        if data == self._saved:
+            return
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, save_state, self.state_file, data)
+            self._saved = data
+        except OSError as e:
+            logger.warning("Не удалось сохранить batch-задания в %s: %s", self.state_file, e)
+
+    async def resume(self):
+        """Восстановление отправленных до перезапуска заданий (True — восстановлены все)"""
+        state = await asyncio.get_running_loop().run_in_executor(None, load_state, self.state_file)
+        since = time.time() - BATCH_RESUME_WINDOW
+        complete = True
+        async for batch in self.openai_client.batches.list(limit=100):
+            if batch.created_at < since:
+                break
+            if (batch.metadata or {}).get("source") != self.source or batch.id in self.batches:
+                continue
+
+            # Входной файл удаляется после рассылки ответов — нет файла, значит задание уже обработано
+            try:
+                await self.openai_client.files.retrieve(batch.input_file_id)
+            except NotFoundError:
+                continue
+            except Exception as e:
+                logger.error("Не удалось проверить batch %s: %s", batch.id, e)
+                complete = False
+                continue
+
+            # Без сохранённого состояния (диск не пережил перезапуск) ответы доставляются по данным из custom_id
+            self.batches[batch.id] = state.get(batch.id)
+            logger.info("Batch %s восстановлен", batch.id)
+        return complete
+
+    async def collect(self):
+        """Проверка статуса отправленных заданий и рассылка ответов"""
+        for batch_id in list(self.batches):
+            try:
+                await self._collect_one(batch_id)
+            except Exception as e:
+                logger.error("Ошибка обработки batch %s: %s", batch_id, e)
+        await self.save()
+
+    async def _collect_one(self, batch_id):
+        """Рассылка ответов одного задания, если оно завершилось"""
+        batch = await self.openai_client.batches.retrieve(batch_id)
+
+        if batch.status in ("failed", "expired", "cancelled") or (
+            batch.status == "completed" and not batch.output_file_id
+        ):
+            logger.error("Batch %s завершился со статусом %s", batch_id, batch.status)
+            for item in (self.batches.pop(batch_id) or {}).values():
+                await self._notify_failure(item)
+            await self._forget(batch)
+            return
+        if batch.status != "completed":
+            return
+
+        content = await self.openai_client.files.content(batch.output_file_id)
+        records = {}
+        for line in content.text.splitlines():
+            if line:
+                record = orjson.loads(line)
+                records[record["custom_id"]] = record
+
+        # Доставленные запросы удаляются из items — при повторе остаются только недоставленные
+        items = self.batches[batch_id]
+        if items is None:
+            items = {custom_id: item_from_custom_id(custom_id) for custom_id in records}
+            self.batches[batch_id] = items
+
+        for custom_id, item in list(items.items()):
+            record = records.get(custom_id)
+            if record is None:
+                # Запрос, на который не пришёл ответ
+                await self._notify_failure(item)
+                del items[custom_id]
+                continue
+            try:
+                processed_text = record["response"]["body"]["choices"][0]["message"]["content"].strip()
+            except (KeyError, IndexError, TypeError):
+                logger.error("Ошибка в ответе batch для %s: %s", custom_id, record.get("error"))
+                processed_text = None
+
+            if await self.deliver(item, processed_text):
+                del items[custom_id]
+
+        if items:
+            logger.warning("Batch %s: не доставлено %s ответов, повторим позже", batch_id, len(items))
+            return
+        del self.batches[batch_id]
+        await self._forget(batch)
+        logger.info("Batch %s обработан", batch_id)
+
+    async def _notify_failure(self, item):
+        """Уведомление о неудачной обработке (ошибка отправки только логируется)"""
+        try:
+            await self.notify_failure(item)
+        except Exception as e:
+            logger.error("Ошибка отправки уведомления для %s: %s", item["custom_id"], e)
+
+    async def _forget(self, batch):
+        """Удаление входного файла обработанного задания (чтобы не восстановить его повторно)"""
+        try:
+            await self.openai_client.files.delete(batch.input_file_id)
+        except Exception as e:
+            logger.warning("Не удалось удалить входной файл batch %s: %s", batch.id, e)
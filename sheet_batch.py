@@ -0,0 +1,36 @@
+"""Пакетная запись строк в Google таблицу, общая для обоих ботов."""
+import asyncio
+from datetime import datetime
+
+def format_timestamp(dt=None):
+    """Время в формате дд.мм.гггг чч:мм:сс (без strftime)"""
+    dt = dt or datetime.now()
+    return f"{dt.day:02d}.{dt.month:02d}.{dt.year} {dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}"
+
+async def flush_loop(queue, send_batch, batch_size, flush_delay):
+    """Сбор строк из очереди в пакеты и отправка через send_batch (None в очереди — сигнал остановки)"""
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        row = await queue.get()
+        if row is None:
+            break
+        rows = [row]
+        deadline = loop.time() + flush_delay
+        
+        # Добираем пакет, пока не истекло время ожидания
+        while len(rows) < batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                row = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if row is None:
+                # Остановка: отправляем уже собранный пакет и выходим
+                stopping = True
+                break
+            rows.append(row)
+        
+        await send_batch(rows)
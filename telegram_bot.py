@@ -1,30 +1,152 @@
 import os
 import asyncio
 import logging
-from datetime import datetime
-from openai import OpenAI
+import logging.handlers
+import queue
+import atexit
+import time
+import hashlib
+import orjson
+from openai import AsyncOpenAI
 from telegram import Update
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-import requests
-from io import BytesIO
+from telegram.request import HTTPXRequest
+import httpx
 import speech_recognition as sr
-from pydub import AudioSegment
-import tempfile
+import numpy as np
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from cachetools import TTLCache
 from dotenv import load_dotenv
+from audio_decode import SAMPLE_RATE, decode_and_trim
+from gpt_batch import GptBatchQueue, make_custom_id
+from sheet_batch import flush_loop, format_timestamp
+from telegram_text import prefix_len, tg_len
+
+# Локальное распознавание речи (если установлен faster-whisper: pip install -r requirements-whisper.txt)
+try:
+    from faster_whisper import WhisperModel
+except ImportError:
+    WhisperModel = None
 
 # ==============================
 # Логирование
 # ==============================
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO
-)
 logger = logging.getLogger(__name__)
 
+def setup_logging():
+    """Записи уходят в очередь, а в stderr их пишет отдельный поток,
+    чтобы вывод логов не блокировал event loop.
+    Вызывается только при запуске бота: процессы пула декодирования импортируют
+    этот модуль повторно, и поток логирования им не нужен"""
+    log_queue = queue.Queue(-1)
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+        handlers=[logging.handlers.QueueHandler(log_queue)]
+    )
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+    listener.start()
+    atexit.register(listener.stop)
+
+# JSON сериализуем через orjson и передаём готовыми байтами
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Пакетная запись в Google Sheets
+SHEET_BATCH_SIZE = 50       # максимум строк в одном запросе
+SHEET_FLUSH_DELAY = 0.5     # сколько ждать добора пакета, сек
+
+# Как часто обновлять сообщение при потоковом ответе GPT, сек
+# (Telegram: ~1 правка в секунду на чат)
+STREAM_EDIT_INTERVAL = 1.0
+
+# Максимальная длина сообщения Telegram
+TELEGRAM_MAX_MESSAGE = 4096
+
+# Параметры запроса к GPT
+GPT_MODEL = "gpt-4o-mini"
+SYSTEM_PROMPT = "Структурируй идею пользователя кратко."
+SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+GPT_MAX_TOKENS = 256
+GPT_MAX_INPUT_CHARS = 4000  # длинные сообщения обрезаем
+
+# Кэш ответов GPT
+GPT_CACHE_SIZE = 2048
+GPT_CACHE_TTL = 3600        # сек
+GPT_MIN_TEXT_LENGTH = 8     # более короткие сообщения не отправляем в GPT
+
+# Отложенная обработка через OpenAI Batch API (/later)
+GPT_BATCH_SOURCE = "fedorai-telegram-bot"   # метка заданий этого бота в metadata
+GPT_BATCH_STATE_FILE = os.getenv("GPT_BATCH_STATE_FILE", "gpt_batches.json")   # запросы отправленных заданий
+
+# Тексты команд
+START_TEXT = (
+    "👋 Привет! Я бот для обработки идей.\n"
+    "Отправь мне текст или голосовое сообщение — я обработаю его через GPT 🤖"
+)
+HELP_TEXT = (
+    "📋 Я умею:\n"
+    "• Обрабатывать текст через ChatGPT\n"
+    "• Распознавать голосовые и структурировать мысль\n"
+    "• Сохранять данные в Google таблицу\n"
+    "• Создавать задачи в Bitrix24\n\n"
+    "Команды:\n"
+    "• /start — запуск\n"
+    "• /help — справка\n"
+    "• /stats — твоя статистика\n"
+    "• /later <текст> — обработать без спешки (ответ в течение суток)"
+)
+
+# Фильтры обработчиков
+_TEXT_FILTER = filters.TEXT & ~filters.COMMAND
+_VOICE_FILTER = filters.VOICE
+
+# Распознавание речи: STT_BACKEND=openai — через OpenAI,
+# иначе локально (faster-whisper, если установлен, или Google)
+STT_MODEL = "whisper-1"
+
+# Распознаватель Google создаём один раз на весь процесс. Порог громкости задан
+# вручную — тишина уже вырезана, подстройка под шум не нужна
+_RECOGNIZER = sr.Recognizer()
+_RECOGNIZER.energy_threshold = 300
+_RECOGNIZER.pause_threshold = 0.8
+_RECOGNIZER.dynamic_energy_threshold = False
+
+def fit_message(text: str) -> str:
+    """Обрезка текста до лимита длины сообщения Telegram (Telegram считает длину в UTF-16)"""
+    if tg_len(text) <= TELEGRAM_MAX_MESSAGE:
+        return text
+    return text[:prefix_len(text, TELEGRAM_MAX_MESSAGE - 1)] + "…"
+
+# ==============================
+# Модель Whisper (загружается один раз)
+# ==============================
+_whisper = None
+_whisper_lock = threading.Lock()
+
+def get_whisper():
+    """Ленивая загрузка модели faster-whisper (int8 на CPU)"""
+    global _whisper
+    if _whisper is None:
+        with _whisper_lock:
+            if _whisper is None:
+                model_name = os.getenv("WHISPER_MODEL", "base")
+                _whisper = WhisperModel(model_name, device="cpu", compute_type="int8")
+                logger.info(f"✅ Модель Whisper '{model_name}' загружена")
+    return _whisper
+
 # ==============================
 # Основной класс бота
 # ==============================
 class TelegramBotWithAppsScript:
+    # Неизменяемые поля задачи в Bitrix24
+    _BITRIX_TEMPLATE = {
+        "RESPONSIBLE_ID": 1,
+        "PRIORITY": "1"
+    }
+    
     def __init__(self):
         # Загружаем env
         load_dotenv()
@@ -37,12 +159,98 @@ class TelegramBotWithAppsScript:
         self.openai_api_key = os.getenv("OPENAI_API_KEY")
         self.bitrix_webhook = os.getenv("BITRIX_WEBHOOK_URL")
         self.google_script_url = os.getenv("GOOGLE_SCRIPT_URL")
+        self.stt_backend = os.getenv("STT_BACKEND", "openai")
+        
+        # Декодирование аудио нагружает CPU — выносим его в отдельные процессы,
+        # чтобы не блокировать event loop (нужно только локальному распознаванию).
+        # forkserver: fork процесса с потоками логирования и HTTP-пулами может зависнуть.
+        # Сам сервер загружает только audio_decode, но каждый процесс пула при старте
+        # заново импортирует этот скрипт (как __mp_main__) со всеми зависимостями бота,
+        # поэтому процессов немного: DECODE_WORKERS, по умолчанию 2
+        # (os.cpu_count() в контейнере — это ядра хоста)
+        self._cpu_pool = None
+        if self.stt_backend != "openai":
+            mp_context = multiprocessing.get_context("forkserver")
+            mp_context.set_forkserver_preload(["audio_decode"])
+            self._cpu_pool = ProcessPoolExecutor(
+                max_workers=int(os.getenv("DECODE_WORKERS", "2")),
+                mp_context=mp_context
+            )
+        
+        # faster-whisper нагружает CPU одной общей моделью: одновременных распознаваний
+        # не больше, чем ядер, — остальные ждут в очереди пула. Google Speech Recognition
+        # (без faster-whisper) ждёт сеть — для него потоков столько же, сколько в пуле по умолчанию
+        self._stt_pool = None
+        if self.stt_backend != "openai":
+            cpus = os.cpu_count() or 1
+            default_threads = cpus if WhisperModel is not None else min(32, cpus + 4)
+            self._stt_pool = ThreadPoolExecutor(
+                max_workers=int(os.getenv("STT_THREADS", str(default_threads))),
+                thread_name_prefix="fedorai-stt"
+            )
         
         # Инициализация OpenAI
-        self.openai_client = OpenAI(api_key=self.openai_api_key)
+        # Повторы при 429/таймаутах с экспоненциальной задержкой делает сам SDK
+        self.openai_client = AsyncOpenAI(
+            api_key=self.openai_api_key,
+            max_retries=int(os.getenv("GPT_MAX_RETRIES", "3")),
+            http_client=httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(max_keepalive_connections=50)
+            )
+        )
+        self._gpt_cache = TTLCache(maxsize=GPT_CACHE_SIZE, ttl=GPT_CACHE_TTL)
+        self._gpt_sem = asyncio.Semaphore(int(os.getenv("GPT_CONCURRENCY", "16")))
+        self._gpt_inflight = {}
+        
+        # Отложенные запросы (/later) через OpenAI Batch API
+        self._gpt_batch = GptBatchQueue(
+            self.openai_client,
+            source=GPT_BATCH_SOURCE,
+            model=GPT_MODEL,
+            system_msg=SYSTEM_MSG,
+            max_tokens=GPT_MAX_TOKENS,
+            max_input_chars=GPT_MAX_INPUT_CHARS,
+            deliver=self._deliver_batch_answer,
+            notify_failure=self._notify_batch_failure,
+            state_file=GPT_BATCH_STATE_FILE
+        )
+        self._gpt_batcher = None
         
-        # Инициализация Telegram
-        self.app = Application.builder().token(self.telegram_token).build()
+        # Общий HTTP-клиент для Google Script и Bitrix (keep-alive + HTTP/2).
+        # Apps Script отвечает на запросы редиректом, поэтому follow_redirects
+        self.http = httpx.AsyncClient(
+            timeout=10,
+            http2=True,
+            follow_redirects=True,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=60)
+        )
+        
+        # Очередь строк для пакетной записи в Google Sheets
+        self._sheet_queue: asyncio.Queue = asyncio.Queue()
+        self._flusher = None
+        
+        # Фоновые задачи (Bitrix), которые нужно дождаться при остановке
+        self._bg_tasks = set()
+        
+        # Инициализация Telegram (HTTP/2 к Bot API; для getUpdates —
+        # отдельный пул, чтобы long polling не занимал соединения ответов)
+        self.app = (
+            Application.builder()
+            .token(self.telegram_token)
+            .request(HTTPXRequest(
+                http_version="2",
+                connection_pool_size=64,
+                connect_timeout=5,
+                read_timeout=20
+            ))
+            .get_updates_request(HTTPXRequest(http_version="2", connect_timeout=5))
+            .concurrent_updates(True)
+            .post_init(self.on_startup)
+            .post_stop(self.on_stop)
+            .post_shutdown(self.on_shutdown)
+            .build()
+        )
         self.setup_handlers()
     
     def _validate_env_variables(self):
@@ -67,17 +275,15 @@ class TelegramBotWithAppsScript:
         self.app.add_handler(CommandHandler("start", self.start_command))
         self.app.add_handler(CommandHandler("help", self.help_command))
         self.app.add_handler(CommandHandler("stats", self.stats_command))
-        self.app.add_handler(MessageHandler(filters.VOICE, self.handle_voice))
-        self.app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_text))
+        self.app.add_handler(CommandHandler("later", self.later_command))
+        self.app.add_handler(MessageHandler(_VOICE_FILTER, self.handle_voice))
+        self.app.add_handler(MessageHandler(_TEXT_FILTER, self.handle_text))
         logger.info("✅ Обработчики команд настроены")
 
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Команда /start"""
         try:
-            await update.message.reply_text(
-                "👋 Привет! Я бот для обработки идей.\n"
-                "Отправь мне текст или голосовое сообщение — я обработаю его через GPT 🤖"
-            )
+            await update.message.reply_text(START_TEXT)
             logger.info(f"Команда /start от пользователя {update.effective_user.username}")
         except Exception as e:
             logger.error(f"Ошибка в start_command: {e}")
@@ -85,17 +291,7 @@ class TelegramBotWithAppsScript:
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Команда /help"""
         try:
-            await update.message.reply_text(
-                "📋 Я умею:\n"
-                "• Обрабатывать текст через ChatGPT\n"
-                "• Распознавать голосовые и структурировать мысль\n"
-                "• Сохранять данные в Google таблицу\n"
-                "• Создавать задачи в Bitrix24\n\n"
-                "Команды:\n"
-                "• /start — запуск\n"
-                "• /help — справка\n"
-                "• /stats — твоя статистика"
-            )
+            await update.message.reply_text(HELP_TEXT)
             logger.info(f"Команда /help от пользователя {update.effective_user.username}")
         except Exception as e:
             logger.error(f"Ошибка в help_command: {e}")
@@ -108,13 +304,14 @@ class TelegramBotWithAppsScript:
             
         try:
             username = update.effective_user.username or "unknown"
-            url = f"{self.google_script_url}?action=getStats&user={username}"
-            
-            response = await asyncio.to_thread(requests.get, url, timeout=10)
+            response = await self.http.get(
+                self.google_script_url,
+                params={"action": "getStats", "user": username}
+            )
             
             if response.status_code == 200:
                 try:
-                    stats_data = response.json()
+                    stats_data = orjson.loads(response.content)
                     await update.message.reply_text(f"📊 Ваша статистика: {stats_data}")
                     logger.info(f"Статистика получена для {username}")
                 except Exception as json_error:
@@ -123,7 +320,7 @@ class TelegramBotWithAppsScript:
                 await update.message.reply_text("❌ Не удалось получить статистику")
                 logger.error(f"Ошибка получения статистики: {response.status_code}")
                 
-        except asyncio.TimeoutError:
+        except httpx.TimeoutException:
             await update.message.reply_text("❌ Таймаут при получении статистики")
             logger.error("Таймаут при получении статистики")
         except Exception as e:
@@ -134,6 +331,10 @@ class TelegramBotWithAppsScript:
     # Текстовые сообщения
     # ==============================
     async def handle_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Текстовое сообщение: обработка уходит в фоновую задачу"""
+        context.application.create_task(self._handle_text_bg(update, context), update=update)
+
+    async def _handle_text_bg(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка текстовых сообщений"""
         text = update.message.text
         username = update.effective_user.username or "unknown"
@@ -145,23 +346,28 @@ class TelegramBotWithAppsScript:
         
         try:
             # Обработка через GPT
-            processed_text = await self.process_with_chatgpt(text)
+            processed_text = await self.process_with_chatgpt(text, processing_msg)
             
-            # Сохранение данных
-            await self.save_to_google_sheet(username, user_id, "text", text, processed_text)
+            # Сохранение только ставится в очередь — делаем его до ответа,
+            # чтобы сбой правки сообщения не лишил таблицу и Bitrix результата
+            await self.save_results(username, user_id, "text", text, processed_text)
             
             # Отправка результата
-            await processing_msg.edit_text(f"✅ Обработано:\n\n{processed_text}")
+            await processing_msg.edit_text(fit_message(f"✅ Обработано:\n\n{processed_text}"))
             logger.info(f"Текст обработан для {username}")
             
         except Exception as e:
-            logger.error(f"Ошибка handle_text: {e}")
-            await processing_msg.edit_text("❌ Ошибка при обработке текста")
+            logger.error(f"Ошибка _handle_text_bg: {e}")
+            await self._show_error(processing_msg, "❌ Ошибка при обработке текста")
 
     # ==============================
     # Голосовые сообщения
     # ==============================
     async def handle_voice(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Голосовое сообщение: обработка уходит в фоновую задачу"""
+        context.application.create_task(self._handle_voice_bg(update, context), update=update)
+
+    async def _handle_voice_bg(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка голосовых сообщений"""
         username = update.effective_user.username or "unknown"
         user_id = update.effective_user.id
@@ -172,166 +378,310 @@ class TelegramBotWithAppsScript:
         
         try:
             # Скачивание файла
+            # (file_path в PTB уже содержит полный URL файла)
             voice_file = await context.bot.get_file(update.message.voice.file_id)
-            voice_bytes = BytesIO()
-            await voice_file.download_to_memory(voice_bytes)
-            voice_bytes.seek(0)
+            response = await self.http.get(voice_file.file_path)
+            response.raise_for_status()
+            voice_data = response.content
             
-            # Конвертация в текст (неблокирующая)
-            text = await asyncio.to_thread(self.voice_to_text, voice_bytes)
+            # Конвертация в текст
+            text = await self.transcribe(voice_data)
             
             if not text:
                 await processing_msg.edit_text("❌ Не удалось распознать голос")
                 return
             
-            await processing_msg.edit_text(f"📝 Распознано: {text[:100]}...")
             logger.info(f"Голос распознан для {username}: {text[:50]}...")
             
             # Обработка через GPT
-            processed_text = await self.process_with_chatgpt(text)
+            processed_text = await self.process_with_chatgpt(text, processing_msg)
             
-            # Сохранение данных
-            await self.save_to_google_sheet(username, user_id, "voice", text, processed_text)
+            # Сохранение только ставится в очередь — делаем его до ответа,
+            # чтобы сбой правки сообщения не лишил таблицу и Bitrix результата
+            await self.save_results(username, user_id, "voice", text, processed_text)
             
             # Отправка результата
-            await processing_msg.edit_text(f"✅ Обработано:\n\n{processed_text}")
+            await processing_msg.edit_text(fit_message(f"✅ Обработано:\n\n{processed_text}"))
             logger.info(f"Голосовое обработано для {username}")
             
         except Exception as e:
-            logger.error(f"Ошибка handle_voice: {e}")
-            await processing_msg.edit_text("❌ Ошибка при обработке голосового сообщения")
+            logger.error(f"Ошибка _handle_voice_bg: {e}")
+            await self._show_error(processing_msg, "❌ Ошибка при обработке голосового сообщения")
+
+    async def _show_error(self, processing_msg, text):
+        """Сообщение об ошибке в processing_msg (сбой самой правки только логируем)"""
+        try:
+            await processing_msg.edit_text(text)
+        except Exception as e:
+            logger.error(f"Не удалось показать ошибку пользователю: {e}")
 
     # ==============================
     # GPT обработка
     # ==============================
-    async def process_with_chatgpt(self, text: str) -> str:
-        """Обработка текста через ChatGPT"""
+    async def process_with_chatgpt(self, text: str, processing_msg=None) -> str:
+        """Обработка текста через ChatGPT (с потоковым выводом в processing_msg)"""
+        # Слишком короткие сообщения возвращаем как есть
+        if len(text.strip()) < GPT_MIN_TEXT_LENGTH:
+            return text
+        
+        # Повторные запросы отдаём из кэша
+        normalized = " ".join(text.lower().split())
+        cache_key = hashlib.blake2b(normalized.encode(), digest_size=16).digest()
+        cached = self._gpt_cache.get(cache_key)
+        if cached is not None:
+            logger.info("✅ Ответ GPT взят из кэша")
+            return cached
+        
+        # Тот же текст уже обрабатывается (например, пользователь отправил его повторно) —
+        # ждём готовый ответ вместо второго запроса
+        inflight = self._gpt_inflight.get(cache_key)
+        while inflight is not None:
+            logger.info("Ожидаем ответ GPT на такой же текст")
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                # Отменили нас самих — пробрасываем; отменили первый запрос — делаем свой
+                if not inflight.cancelled():
+                    raise
+            inflight = self._gpt_inflight.get(cache_key)
+        
+        future = asyncio.get_running_loop().create_future()
+        self._gpt_inflight[cache_key] = future
         try:
-            logger.info("Отправка запроса в OpenAI...")
-            
-            response = await asyncio.to_thread(
-                self.openai_client.chat.completions.create,
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "Ты помощник, который структурирует идеи и мысли пользователя. Делай ответ кратким, но информативным."},
-                    {"role": "user", "content": text}
-                ],
-                max_tokens=600,
-                temperature=0.7
-            )
-            
-            result = response.choices[0].message.content.strip()
-            logger.info("✅ Получен ответ от OpenAI")
-            return result
-            
+            result = await self._stream_chatgpt(text, processing_msg)
+            self._gpt_cache[cache_key] = result
         except Exception as e:
             logger.error(f"Ошибка GPT: {e}")
-            return f"❌ Ошибка обработки GPT. Исходный текст:\n\n{text}"
+            result = f"❌ Ошибка обработки GPT. Исходный текст:\n\n{text}"
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        finally:
+            del self._gpt_inflight[cache_key]
+        
+        future.set_result(result)
+        return result
+
+    async def _stream_chatgpt(self, text: str, processing_msg=None) -> str:
+        """Потоковый запрос к OpenAI с периодическим обновлением processing_msg"""
+        logger.info("Отправка запроса в OpenAI...")
+        
+        # Ограничиваем число одновременных запросов к OpenAI. Правки сообщения идут
+        # отдельной задачей: медленный Telegram не должен занимать место в семафоре
+        edit_task = None
+        try:
+            async with self._gpt_sem:
+                stream = await self.openai_client.chat.completions.create(
+                    model=GPT_MODEL,
+                    messages=[
+                        SYSTEM_MSG,
+                        {"role": "user", "content": text[:GPT_MAX_INPUT_CHARS]}
+                    ],
+                    max_tokens=GPT_MAX_TOKENS,
+                    temperature=0.7,
+                    stream=True
+                )
+                
+                parts = []
+                shown = ""
+                last_edit = time.monotonic()
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    parts.append(chunk.choices[0].delta.content or "")
+                    
+                    # Периодически показываем частичный ответ (если прошлая правка уже завершилась)
+                    if (processing_msg and time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL
+                            and (edit_task is None or edit_task.done())):
+                        partial = "".join(parts).strip()
+                        if partial and partial != shown:
+                            edit_task = asyncio.create_task(self._show_partial(processing_msg, partial))
+                            shown = partial
+                        last_edit = time.monotonic()
+        finally:
+            # Последняя частичная правка должна завершиться до итоговой
+            if edit_task is not None:
+                await asyncio.gather(edit_task, return_exceptions=True)
+        
+        logger.info("✅ Получен ответ от OpenAI")
+        return "".join(parts).strip()
+
+    async def _show_partial(self, processing_msg, partial: str):
+        """Показ частичного ответа GPT в processing_msg"""
+        try:
+            await processing_msg.edit_text(fit_message(partial))
+        except Exception as e:
+            logger.warning(f"Не удалось обновить сообщение: {e}")
 
     # ==============================
-    # Speech-to-text (синхронная функция)
+    # Отложенная обработка (OpenAI Batch API)
     # ==============================
-    def voice_to_text(self, voice_bytes):
-        """Конвертация голоса в текст"""
-        temp_ogg_path = None
-        temp_wav_path = None
+    async def later_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Команда /later — обработка идеи без спешки через Batch API"""
+        text = " ".join(context.args)
+        if not text:
+            await update.message.reply_text("✍️ Использование: /later <текст идеи>")
+            return
         
+        item = {
+            "chat_id": update.effective_chat.id,
+            "username": update.effective_user.username or "unknown",
+            "user_id": update.effective_user.id,
+            "text": text
+        }
+        item["custom_id"] = make_custom_id(item["chat_id"], item["user_id"], update.message.message_id, item["username"])
+        self._gpt_batch.add(item)
+        await update.message.reply_text("🕓 Идея принята. Ответ придёт позже (до 24 часов)")
+        logger.info(f"Идея поставлена в отложенную обработку для {item['username']}")
+
+    async def _deliver_batch_answer(self, item, processed_text) -> bool:
+        """Отправка ответа batch пользователю (False — временная ошибка, повторим позже)"""
+        if processed_text is None:
+            processed_text = f"❌ Ошибка обработки GPT. Исходный текст:\n\n{item['text']}"
         try:
-            # Сохраняем ogg файл
-            with tempfile.NamedTemporaryFile(suffix=".ogg", delete=False) as temp_ogg:
-                temp_ogg.write(voice_bytes.read())
-                temp_ogg_path = temp_ogg.name
-            
-            # Конвертируем в wav
-            audio = AudioSegment.from_ogg(temp_ogg_path)
-            audio = audio.set_frame_rate(16000).set_channels(1)
-            
-            with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_wav:
-                temp_wav_path = temp_wav.name
-                audio.export(temp_wav_path, format="wav")
-            
-            # Распознаем речь
-            recognizer = sr.Recognizer()
-            with sr.AudioFile(temp_wav_path) as source:
-                audio_data = recognizer.record(source)
-                try:
-                    text = recognizer.recognize_google(audio_data, language="ru-RU")
-                    logger.info("✅ Голос успешно распознан")
-                    return text
-                except sr.UnknownValueError:
+            await self.app.bot.send_message(item["chat_id"], fit_message(f"✅ Обработано:\n\n{processed_text}"))
+        except (Forbidden, BadRequest) as e:
+            # Бот заблокирован или чат недоступен — повтор не поможет
+            logger.error(f"Ответ batch для {item['custom_id']} не доставлен: {e}")
+            return True
+        except (RetryAfter, NetworkError) as e:
+            logger.warning(f"Ответ batch для {item['custom_id']} не доставлен, повторим позже: {e}")
+            return False
+        await self.save_results(item["username"], item["user_id"], "text", item["text"], processed_text)
+        return True
+
+    async def _notify_batch_failure(self, item):
+        """Сообщение пользователю о неудачной отложенной обработке"""
+        await self.app.bot.send_message(item["chat_id"], "❌ Не удалось обработать отложенную идею")
+
+    # ==============================
+    # Speech-to-text
+    # ==============================
+    async def transcribe(self, voice_data: bytes):
+        """Распознавание голоса выбранным движком (STT_BACKEND)"""
+        if self.stt_backend != "openai":
+            try:
+                # Декодируем ogg/opus в PCM прямо в памяти, в пуле процессов
+                pcm = await asyncio.get_running_loop().run_in_executor(self._cpu_pool, decode_and_trim, voice_data)
+            except Exception as e:
+                logger.error(f"Ошибка декодирования голоса: {e}")
+                return None
+            if not pcm:
+                logger.warning("В голосовом сообщении не найдено речи")
+                return None
+            # Контекстные переменные потоку не нужны — обходимся без копии контекста
+            return await asyncio.get_running_loop().run_in_executor(self._stt_pool, self.voice_to_text, pcm)
+        
+        try:
+            # OpenAI принимает ogg/opus как есть — без декодирования
+            result = await self.openai_client.audio.transcriptions.create(
+                model=STT_MODEL,
+                file=("voice.ogg", voice_data, "audio/ogg"),
+                language="ru"
+            )
+            text = result.text.strip()
+            if not text:
+                logger.warning("Не удалось распознать речь")
+                return None
+            logger.info("✅ Голос успешно распознан")
+            return text
+        except Exception as e:
+            logger.error(f"Ошибка transcribe: {e}")
+            return None
+
+    def voice_to_text(self, pcm: bytes):
+        """Локальное распознавание PCM 16 кГц моно (синхронная функция)"""
+        try:
+            # Распознаем речь локально, если доступен Whisper
+            if WhisperModel is not None:
+                samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+                segments, _ = get_whisper().transcribe(samples, language="ru", vad_filter=True)
+                text = " ".join(segment.text.strip() for segment in segments).strip()
+                if not text:
                     logger.warning("Не удалось распознать речь")
                     return None
-                except sr.RequestError as e:
-                    logger.error(f"Ошибка сервиса распознавания: {e}")
-                    return None
+                logger.info("✅ Голос успешно распознан")
+                return text
+            
+            # Иначе — через Google Speech Recognition
+            audio_data = sr.AudioData(pcm, SAMPLE_RATE, 2)
+            try:
+                text = _RECOGNIZER.recognize_google(audio_data, language="ru-RU")
+                logger.info("✅ Голос успешно распознан")
+                return text
+            except sr.UnknownValueError:
+                logger.warning("Не удалось распознать речь")
+                return None
+            except sr.RequestError as e:
+                logger.error(f"Ошибка сервиса распознавания: {e}")
+                return None
             
         except Exception as e:
             logger.error(f"Ошибка voice_to_text: {e}")
             return None
-        finally:
-            # Очистка временных файлов
-            if temp_ogg_path and os.path.exists(temp_ogg_path):
-                os.unlink(temp_ogg_path)
-            if temp_wav_path and os.path.exists(temp_wav_path):
-                os.unlink(temp_wav_path)
 
     # ==============================
     # Google Sheets + Bitrix
     # ==============================
+    async def save_results(self, username, user_id, message_type, original_text, processed_text):
+        """Сохранение в Google Sheets и фоновое создание задачи в Bitrix24"""
+        if self.bitrix_webhook:
+            # Результат задачи пользователю не нужен — не ждём ответа Bitrix
+            task = asyncio.create_task(self.create_bitrix_task(processed_text, username))
+            self._bg_tasks.add(task)
+            task.add_done_callback(self._bg_tasks.discard)
+        await self.save_to_google_sheet(username, user_id, message_type, original_text, processed_text)
+
     async def save_to_google_sheet(self, username, user_id, message_type, original_text, processed_text):
-        """Сохранение в Google Sheets"""
+        """Постановка строки в очередь на запись в Google Sheets"""
         if not self.google_script_url:
             logger.info("Google Script URL не настроен, пропускаем сохранение")
             return
         
+        await self._sheet_queue.put({
+            "timestamp": format_timestamp(),
+            "username": username,
+            "user_id": str(user_id),
+            "message_type": message_type,
+            "original_text": original_text,
+            "processed_text": processed_text
+        })
+
+    async def _send_sheet_batch(self, rows):
+        """Сохранение пакета строк в Google Sheets одним запросом"""
         try:
             data = {
-                "action": "saveMessage",
-                "timestamp": datetime.now().strftime("%d.%m.%Y %H:%M:%S"),
-                "username": username,
-                "user_id": str(user_id),
-                "message_type": message_type,
-                "original_text": original_text,
-                "processed_text": processed_text
+                "action": "saveMessagesBatch",
+                "rows": rows
             }
             
-            response = await asyncio.to_thread(
-                requests.post, 
-                self.google_script_url, 
-                json=data, 
-                timeout=10
-            )
+            response = await self.http.post(self.google_script_url, content=orjson.dumps(data), headers=JSON_HEADERS)
             
             if response.status_code == 200:
-                logger.info("✅ Данные сохранены в Google Sheets")
-                # Создаем задачу в Bitrix, если настроен
-                if self.bitrix_webhook:
-                    await self.create_bitrix_task(processed_text, username)
+                logger.info(f"✅ Данные сохранены в Google Sheets: {len(rows)} строк")
             else:
                 logger.error(f"Ошибка сохранения в Google Sheets: {response.status_code} - {response.text}")
                 
-        except asyncio.TimeoutError:
+        except httpx.TimeoutException:
             logger.error("Таймаут при сохранении в Google Sheets")
         except Exception as e:
-            logger.error(f"Ошибка save_to_google_sheet: {e}")
+            logger.error(f"Ошибка _send_sheet_batch: {e}")
 
     async def create_bitrix_task(self, description, username):
         """Создание задачи в Bitrix24"""
         try:
             task_data = {
                 "fields": {
+                    **self._BITRIX_TEMPLATE,
                     "TITLE": f"Новая идея из Telegram от {username}",
-                    "DESCRIPTION": description,
-                    "RESPONSIBLE_ID": 1,
-                    "PRIORITY": "1"
+                    "DESCRIPTION": description
                 }
             }
             
-            response = await asyncio.to_thread(
-                requests.post, 
-                f"{self.bitrix_webhook}/tasks.task.add", 
-                json=task_data, 
-                timeout=10
+            response = await self.http.post(
+                f"{self.bitrix_webhook}/tasks.task.add",
+                content=orjson.dumps(task_data),
+                headers=JSON_HEADERS
             )
             
             if response.status_code == 200:
@@ -339,21 +689,58 @@ class TelegramBotWithAppsScript:
             else:
                 logger.error(f"Ошибка создания задачи в Bitrix: {response.status_code} - {response.text}")
                 
-        except asyncio.TimeoutError:
+        except httpx.TimeoutException:
             logger.error("Таймаут при создании задачи в Bitrix")
         except Exception as e:
             logger.error(f"Ошибка create_bitrix_task: {e}")
 
     # ==============================
-    # Запуск бота
+    # Запуск и остановка бота
     # ==============================
+    async def on_startup(self, application: Application):
+        """Запуск фоновых задач"""
+        if self.stt_backend != "openai" and WhisperModel is not None:
+            await asyncio.get_running_loop().run_in_executor(self._stt_pool, get_whisper)
+        if self.google_script_url:
+            self._flusher = asyncio.create_task(flush_loop(
+                self._sheet_queue, self._send_sheet_batch, SHEET_BATCH_SIZE, SHEET_FLUSH_DELAY
+            ))
+        self._gpt_batcher = asyncio.create_task(self._gpt_batch.run())
+
+    async def on_stop(self, application: Application):
+        """Остановка рассылки ответов batch, пока бот ещё может отправлять сообщения"""
+        if self._gpt_batcher:
+            self._gpt_batcher.cancel()
+            await asyncio.gather(self._gpt_batcher, return_exceptions=True)
+        # Накопленные /later отправляем сейчас — ответы заберёт следующий запуск
+        await self._gpt_batch.shutdown()
+
+    async def on_shutdown(self, application: Application):
+        """Досохранение очереди и закрытие HTTP-клиента при остановке"""
+        if self._bg_tasks:
+            await asyncio.gather(*self._bg_tasks, return_exceptions=True)
+        if self._flusher:
+            # Флашер дошлёт всё, что стоит в очереди перед сигналом остановки
+            await self._sheet_queue.put(None)
+            await asyncio.gather(self._flusher, return_exceptions=True)
+        await self.http.aclose()
+        await self.openai_client.close()
+        if self._cpu_pool:
+            self._cpu_pool.shutdown(wait=False)
+        if self._stt_pool:
+            self._stt_pool.shutdown(wait=False)
+        logger.info("✅ HTTP-клиент закрыт")
+
     def run(self):
         """Запуск бота"""
         try:
             logger.info("🚀 Запуск Telegram бота...")
             self.app.run_polling(
                 drop_pending_updates=True,
-                allowed_updates=Update.ALL_TYPES
+                timeout=30,
+                poll_interval=0,
+                bootstrap_retries=3,
+                allowed_updates=[Update.MESSAGE]
             )
         except Exception as e:
             logger.error(f"Критическая ошибка при запуске бота: {e}")
@@ -363,6 +750,7 @@ class TelegramBotWithAppsScript:
 # MAIN
 # ==============================
 if __name__ == "__main__":
+    setup_logging()
     try:
         bot = TelegramBotWithAppsScript()
         bot.run()
@@ -0,0 +1,35 @@
+"""Длина и разбиение текста сообщений по правилам Telegram."""
+
+def tg_len(text):
+    """Длина текста так, как её считает Telegram (в единицах UTF-16)"""
+    return len(text.encode("utf-16-le")) // 2
+
+def prefix_len(text, limit):
+    """Число символов самого длинного начала text, которое укладывается в limit единиц UTF-16"""
+    # Символ вне BMP (эмодзи) занимает две единицы
+    cut = units = 0
+    for char in text:
+        units += 2 if ord(char) > 0xFFFF else 1
+        if units > limit:
+            break
+        cut += 1
+    return cut
+
+def split_message(text, limit):
+    """Разбиение текста на части не длиннее limit (по возможности — по абзацам)"""
+    parts = []
+    while tg_len(text) > limit:
+        # Хотя бы один символ забираем всегда, иначе цикл не продвинется
+        cut = max(prefix_len(text, limit), 1)
+        paragraph = text.rfind("\n\n", 0, cut)
+        if paragraph > 0:
+            cut = paragraph
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if text or not parts:
+        parts.append(text)
+    return parts
+
+def markdown_balanced(text):
+    """Нет ли в тексте незакрытых сущностей Markdown (*, _, `, [...])"""
+    return not any(text.count(marker) % 2 for marker in "*_`") and text.count("[") == text.count("]")
@@ -0,0 +1,75 @@
+import unittest
+
+from telegram_text import markdown_balanced, prefix_len, split_message, tg_len
+
+
+class TgLenTest(unittest.TestCase):
+    def test_bmp_characters_count_once(self):
+        self.assertEqual(tg_len("Привет"), 6)
+
+    def test_astral_characters_count_twice(self):
+        self.assertEqual(tg_len("😀"), 2)
+        self.assertEqual(tg_len("a😀b"), 4)
+
+
+class PrefixLenTest(unittest.TestCase):
+    def test_counts_utf16_units(self):
+        self.assertEqual(prefix_len("ab😀cd", 3), 2)
+        self.assertEqual(prefix_len("ab😀cd", 4), 3)
+
+    def test_whole_text_fits(self):
+        self.assertEqual(prefix_len("abc", 10), 3)
+
+
+class SplitMessageTest(unittest.TestCase):
+    def assert_parts_fit(self, parts, limit):
+        for part in parts:
+            self.assertLessEqual(tg_len(part), limit)
+
+    def test_short_text_is_single_part(self):
+        self.assertEqual(split_message("abc", 10), ["abc"])
+
+    def test_empty_text(self):
+        self.assertEqual(split_message("", 10), [""])
+
+    def test_prefers_paragraph_boundary(self):
+        parts = split_message("first\n\nsecond", 10)
+        self.assertEqual(parts, ["first", "second"])
+
+    def test_hard_cut_without_paragraphs(self):
+        parts = split_message("a" * 25, 10)
+        self.assertEqual(parts, ["a" * 10, "a" * 10, "a" * 5])
+
+    def test_emoji_only_text_terminates(self):
+        parts = split_message("😀" * 5, 5)
+        self.assertEqual("".join(parts), "😀" * 5)
+        self.assert_parts_fit(parts, 5)
+
+    def test_cut_does_not_split_surrogate_pair(self):
+        parts = split_message("ab😀cd", 3)
+        self.assertEqual(parts, ["ab", "😀c", "d"])
+
+    def test_limit_smaller_than_one_character_still_progresses(self):
+        self.assertEqual(split_message("😀😀", 1), ["😀", "😀"])
+
+    def test_trailing_newlines_do_not_produce_empty_part(self):
+        self.assertEqual(split_message("abc\n\n", 3), ["abc"])
+
+    def test_mixed_text_fits_limit(self):
+        text = ("идея 💡 " * 300 + "\n\n") * 3
+        parts = split_message(text, 100)
+        self.assert_parts_fit(parts, 100)
+        self.assertTrue(all(parts))
+
+
+class MarkdownBalancedTest(unittest.TestCase):
+    def test_closed_entities(self):
+        self.assertTrue(markdown_balanced("*bold* _it_ `code` [link](http://x)"))
+
+    def test_unclosed_entity(self):
+        self.assertFalse(markdown_balanced("*bold"))
+        self.assertFalse(markdown_balanced("[link"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,18 +1,46 @@
 import os
 import logging
+import logging.handlers
+import queue
+import atexit
 import asyncio
-from datetime import datetime
-import openai
-import requests
-from flask import Flask, request, jsonify
-import json
-
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
+from openai import AsyncOpenAI, RateLimitError, APIStatusError
+import httpx
+from aiohttp import web
+import hashlib
+import time
+import orjson
+import numpy as np
+from cachetools import LRUCache, TTLCache
+from gpt_batch import GptBatchQueue, make_custom_id
+from sheet_batch import flush_loop, format_timestamp
+from telegram_text import markdown_balanced, split_message, tg_len
+
+# uvloop ускоряет event loop, но необязателен (нет под Windows)
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# Настройка логирования. Записи уходят в очередь, а в stderr их пишет отдельный поток,
+# чтобы вывод логов не блокировал event loop; сообщения форматируются лениво (%s)
+_log_queue = queue.Queue(-1)
+logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(_log_queue)])
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
 
-# Flask приложение
-app = Flask(__name__)
+# Маршруты aiohttp приложения
+routes = web.RouteTableDef()
+
+# JSON сериализуем через orjson и передаём готовыми байтами
+# (заголовок один раз задаётся в HTTP-клиентах)
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+def json_response(data, status=200):
+    """JSON ответ, сериализованный через orjson"""
+    return web.Response(body=orjson.dumps(data), status=status, content_type='application/json')
 
 # Конфигурация
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
@@ -20,119 +48,471 @@ OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 GOOGLE_SCRIPT_URL = os.getenv('GOOGLE_SCRIPT_URL')
 WEBHOOK_URL = os.getenv('RENDER_EXTERNAL_URL', 'https://fedorai.onrender.com')
 
-# Инициализация
-openai.api_key = OPENAI_API_KEY
+# Системный промпт ChatGPT. Всегда идёт первым и не меняется между запросами,
+# чтобы OpenAI мог кэшировать этот префикс
+SYSTEM_PROMPT = """Ты эксперт по обработке идей и мыслей.
+
+Твоя задача:
+1. Структурировать мысль пользователя
+2. Добавить практические шаги
+3. Определить приоритет
+4. Предложить следующие действия
+
+Отвечай на русском языке. Формат:
+🎯 Суть идеи: [описание]
+📋 План действий: [шаги]
+⚡ Приоритет: [высокий/средний/низкий]
+📊 Метрики: [как измерить успех]"""
+SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+
+# Параметры запроса к GPT
+GPT_MODEL = "gpt-3.5-turbo"
+GPT_MAX_TOKENS = 600
+
+# Отложенная обработка через OpenAI Batch API (/later): вдвое дешевле, ответ до 24 часов
+GPT_BATCH_SOURCE = "fedorai-webhook-bot"    # метка заданий этого бота в metadata
+GPT_BATCH_STATE_FILE = os.getenv('GPT_BATCH_STATE_FILE', 'gpt_batches.json')   # запросы отправленных заданий
+
+# Тексты команд
+START_TEXT = """🤖 *Добро пожаловать в бота для обработки идей!*
+
+Я могу:
+• 💬 Принимать текстовые сообщения  
+• 🧠 Обрабатывать их через ChatGPT
+• 📊 Сохранять результаты
+
+Просто отправьте мне текстовое сообщение!"""
+
+HELP_TEXT = """📋 *Как использовать бота:*
+
+1. Отправьте любую идею или задачу
+2. Бот обработает её через ChatGPT  
+3. Получите структурированный ответ
+
+*Команды:*
+• /start - начать работу
+• /help - эта справка
+• /later <текст> - обработать без спешки (ответ в течение суток)"""
+
+# Итоговое сообщение: заголовок + ответ GPT в пределах лимита длины Telegram
+TELEGRAM_MAX_MESSAGE = 4096
+RESULT_HEADER = "✅ *Сообщение обработано!*\n\n💭 *Обработанная мысль:*\n"
+RESULT_MAX_BODY = TELEGRAM_MAX_MESSAGE - tg_len(RESULT_HEADER)   # Telegram считает длину в UTF-16
+
+# Ответы на команды (webhook reply) кодируем заранее: меняется только chat_id,
+# он подставляется в начало готового тела
+COMMAND_REPLY_TAILS = {
+    command: orjson.dumps({"text": text, "parse_mode": "Markdown"})[1:]
+    for command, text in (('/start', START_TEXT), ('/help', HELP_TEXT))
+}
+
+# Клиент OpenAI (как и остальные HTTP-клиенты) создаётся в lifespan, внутри работающего
+# event loop; семафор ограничивает число одновременных запросов
+openai_client: AsyncOpenAI = None
+gpt_semaphore = asyncio.Semaphore(int(os.getenv('GPT_CONCURRENCY', '16')))
+
+# Предохранитель: после серии 429/5xx на время перестаём обращаться к OpenAI
+BREAKER_THRESHOLD = 3       # ошибок подряд до срабатывания
+BREAKER_COOLDOWN = 30       # сек
+breaker_failures = 0
+breaker_open_until = 0.0
 
-def send_telegram_message_sync(chat_id, text, reply_to_message_id=None):
-    """Синхронная отправка сообщения через Telegram API"""
+# Как часто обновлять сообщение при потоковом ответе (Telegram: ~1 правка в секунду на чат)
+STREAM_EDIT_INTERVAL = 1.0
+
+# Кэш ответов на одинаковые сообщения (повторы, тестовые "ping")
+GPT_CACHE_SIZE = 1024
+gpt_cache = LRUCache(maxsize=GPT_CACHE_SIZE)
+
+# Семантический кэш: перефразированная идея получает сохранённый ответ.
+# Хранится отдельно для каждого пользователя, записи живут SEMANTIC_TTL.
+# Выключен по умолчанию: добавляет запрос эмбеддинга к каждому промаху кэша
+SEMANTIC_CACHE = os.getenv('SEMANTIC_CACHE', '0') == '1'
+EMBEDDING_MODEL = "text-embedding-3-small"
+SEMANTIC_THRESHOLD = 0.93   # минимальное косинусное сходство
+SEMANTIC_TTL = 24 * 3600    # сек
+SEMANTIC_MAX_ENTRIES = 100  # на одного пользователя
+SEMANTIC_MAX_USERS = 200    # пользователи без новых записей за SEMANTIC_TTL вытесняются
+# user_id -> {'times': [...], 'vectors': ndarray[N, D], 'answers': [...]}
+semantic_cache = TTLCache(maxsize=SEMANTIC_MAX_USERS, ttl=SEMANTIC_TTL)
+
+# Пакетная запись в Google таблицу
+SHEET_BATCH_SIZE = 20       # максимум строк в одном запросе
+SHEET_FLUSH_DELAY = 2.0     # сколько ждать добора пакета, сек
+sheet_queue: asyncio.Queue = asyncio.Queue()
+
+# Очередь входящих обновлений: webhook сразу отвечает 200, обработкой занимаются воркеры
+WORK_QUEUE_SIZE = 1000
+WORKERS = int(os.getenv('WEBHOOK_WORKERS', '8'))
+work_queue: asyncio.Queue = asyncio.Queue(maxsize=WORK_QUEUE_SIZE)
+
+# Уже принятые update_id: повторная доставка того же обновления игнорируется
+seen_updates = TTLCache(maxsize=10000, ttl=600)
+
+# Общие HTTP-клиенты: для Google Script и для Telegram (HTTP/2 — одновременные
+# запросы идут по одному соединению). Создаются в lifespan, внутри работающего event loop
+http_client: httpx.AsyncClient = None
+telegram_client: httpx.AsyncClient = None
+
+# Простаивающие соединения держим несколько минут, чтобы не повторять DNS и TLS;
+# сбои установки соединения транспорт повторяет сам
+HTTP_KEEPALIVE_EXPIRY = 300     # сек
+HTTP_CONNECT_RETRIES = 2
+
+def create_http_client():
+    """Создание общего HTTP-клиента с пулом keep-alive соединений"""
+    return httpx.AsyncClient(
+        headers=JSON_HEADERS,
+        timeout=30,
+        follow_redirects=True,
+        transport=httpx.AsyncHTTPTransport(
+            retries=HTTP_CONNECT_RETRIES,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=HTTP_KEEPALIVE_EXPIRY)
+        )
+    )
+
+def create_openai_client():
+    """Создание клиента OpenAI. Повторы при 429/таймаутах с экспоненциальной задержкой делает сам SDK"""
+    return AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        max_retries=int(os.getenv('GPT_MAX_RETRIES', '3')),
+        http_client=httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20)
+        )
+    )
+
+def create_telegram_client():
+    """Создание HTTP/2 клиента для Telegram Bot API"""
+    return httpx.AsyncClient(
+        base_url=f"https://api.telegram.org/bot{TELEGRAM_TOKEN}",
+        headers=JSON_HEADERS,
+        timeout=httpx.Timeout(30.0, connect=5.0),
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            retries=HTTP_CONNECT_RETRIES,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=50, keepalive_expiry=HTTP_KEEPALIVE_EXPIRY)
+        )
+    )
+
+class TelegramError(Exception):
+    """Ошибка Telegram API (transient — запрос можно повторить позже)"""
+    def __init__(self, description, transient=False):
+        super().__init__(description)
+        self.transient = transient
+
+async def telegram_call(method, data):
+    """Запрос к Telegram API; при ошибке — TelegramError"""
+    try:
+        response = await telegram_client.post(f"/{method}", content=orjson.dumps(data))
+    except httpx.HTTPError as e:
+        raise TelegramError(str(e), transient=True) from e
+    
+    if response.status_code == 200:
+        return orjson.loads(response.content).get('result')
+    # Telegram не разобрал разметку — тот же текст уходит без неё
+    if response.status_code == 400 and data.get('parse_mode') and "can't parse entities" in response.text:
+        logger.warning("Разметка отклонена, отправляем без неё: %s", response.text)
+        return await telegram_call(method, {key: value for key, value in data.items() if key != 'parse_mode'})
+    raise TelegramError(response.text, transient=response.status_code == 429 or response.status_code >= 500)
+
+async def send_telegram_message(chat_id, text, reply_to_message_id=None, parse_mode="Markdown"):
+    """Отправка сообщения через Telegram API"""
     try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
         data = {
             "chat_id": chat_id,
-            "text": text,
-            "parse_mode": "Markdown"
+            "text": text
         }
+        if parse_mode:
+            data["parse_mode"] = parse_mode
         
         if reply_to_message_id:
             data["reply_to_message_id"] = reply_to_message_id
         
-        response = requests.post(url, json=data, timeout=30)
-        
-        if response.status_code == 200:
-            result = response.json()
-            return result.get('result', {}).get('message_id')
-        else:
-            logger.error(f"Ошибка отправки сообщения: {response.text}")
-            return None
+        result = await telegram_call("sendMessage", data)
+        return result.get('message_id')
             
     except Exception as e:
-        logger.error(f"Ошибка Telegram API: {e}")
+        logger.error("Ошибка отправки сообщения: %s", e)
         return None
 
-def edit_telegram_message_sync(chat_id, message_id, text):
-    """Синхронное редактирование сообщения через Telegram API"""
+async def edit_telegram_message(chat_id, message_id, text, parse_mode="Markdown"):
+    """Редактирование сообщения через Telegram API"""
     try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/editMessageText"
         data = {
             "chat_id": chat_id,
             "message_id": message_id,
-            "text": text,
-            "parse_mode": "Markdown"
+            "text": text
         }
+        if parse_mode:
+            data["parse_mode"] = parse_mode
         
-        response = requests.post(url, json=data, timeout=30)
-        
-        if response.status_code != 200:
-            logger.error(f"Ошибка редактирования сообщения: {response.text}")
+        await telegram_call("editMessageText", data)
             
     except Exception as e:
-        logger.error(f"Ошибка редактирования: {e}")
+        logger.error("Ошибка редактирования сообщения: %s", e)
 
-def process_with_chatgpt_sync(text):
-    """Синхронная обработка через ChatGPT"""
+async def get_embedding(text):
+    """Нормированный эмбеддинг текста (None при ошибке)"""
     try:
-        logger.info("Отправка запроса в OpenAI...")
-        
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {
-                    "role": "system", 
-                    "content": """Ты эксперт по обработке идей и мыслей.
+        async with gpt_semaphore:
+            response = await openai_client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+        vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+    except Exception as e:
+        logger.error("Ошибка получения эмбеддинга: %s", e)
+        return None
 
-Твоя задача:
-1. Структурировать мысль пользователя
-2. Добавить практические шаги
-3. Определить приоритет
-4. Предложить следующие действия
+def semantic_lookup(user_id, vector):
+    """Поиск ответа на похожее сообщение пользователя"""
+    entry = semantic_cache.get(user_id)
+    if not entry:
+        return None
+    
+    # Записи добавляются по порядку — устаревшие всегда в начале
+    expired = 0
+    deadline = time.monotonic() - SEMANTIC_TTL
+    while expired < len(entry['times']) and entry['times'][expired] < deadline:
+        expired += 1
+    if expired:
+        del entry['times'][:expired]
+        del entry['answers'][:expired]
+        entry['vectors'] = entry['vectors'][expired:]
+        if not entry['times']:
+            del semantic_cache[user_id]
+            return None
+    
+    scores = entry['vectors'] @ vector
+    best = int(np.argmax(scores))
+    if scores[best] >= SEMANTIC_THRESHOLD:
+        return entry['answers'][best]
+    return None
 
-Отвечай на русском языке. Формат:
-🎯 Суть идеи: [описание]
-📋 План действий: [шаги]
-⚡ Приоритет: [высокий/средний/низкий]
-📊 Метрики: [как измерить успех]"""
-                },
-                {"role": "user", "content": text}
-            ],
-            max_tokens=600,
-            temperature=0.7
-        )
+def semantic_store(user_id, vector, answer):
+    """Сохранение ответа в семантический кэш пользователя"""
+    entry = semantic_cache.get(user_id)
+    if not entry:
+        semantic_cache[user_id] = {'times': [time.monotonic()], 'vectors': vector[None, :], 'answers': [answer]}
+        return
+    
+    entry['times'].append(time.monotonic())
+    entry['answers'].append(answer)
+    entry['vectors'] = np.vstack((entry['vectors'], vector))
+    if len(entry['times']) > SEMANTIC_MAX_ENTRIES:
+        del entry['times'][0]
+        del entry['answers'][0]
+        entry['vectors'] = entry['vectors'][1:]
+    
+    # Повторная запись продлевает срок жизни пользователя в кэше
+    semantic_cache[user_id] = entry
+
+async def process_with_chatgpt(text, user_id=None, on_partial=None):
+    """Обработка через ChatGPT (частичный ответ передаётся в on_partial)"""
+    # Повторные запросы отдаём из кэша
+    cache_key = hashlib.blake2b(text.strip().lower().encode(), digest_size=16).digest()
+    cached = gpt_cache.get(cache_key)
+    if cached is not None:
+        logger.info("Ответ взят из кэша")
+        return cached
+    
+    global breaker_failures, breaker_open_until
+    if time.monotonic() < breaker_open_until:
+        logger.warning("OpenAI временно отключён предохранителем")
+        return f"⚠️ ChatGPT временно перегружен, попробуйте позже.\n\nИсходный текст: {text}"
+    
+    # Перефразированные повторы — из семантического кэша
+    vector = None
+    if SEMANTIC_CACHE and user_id is not None:
+        vector = await get_embedding(text)
+        if vector is not None:
+            cached = semantic_lookup(user_id, vector)
+            if cached is not None:
+                logger.info("Ответ взят из кэша (cache=semantic)")
+                return cached
+    
+    try:
+        logger.info("Отправка запроса в OpenAI...")
         
-        result = response.choices[0].message.content.strip()
+        # Частичный ответ показывается отдельной задачей: медленный Telegram
+        # не должен занимать место в семафоре OpenAI
+        partial_task = None
+        try:
+            async with gpt_semaphore:
+                stream = await openai_client.chat.completions.create(
+                    model=GPT_MODEL,
+                    messages=[
+                        SYSTEM_MSG,
+                        {"role": "user", "content": text}
+                    ],
+                    max_tokens=GPT_MAX_TOKENS,
+                    temperature=0.7,
+                    stream=True
+                )
+                
+                parts = []
+                last_edit = time.monotonic()
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    parts.append(chunk.choices[0].delta.content or "")
+                    
+                    # Периодически показываем частичный ответ (если прошлый показ уже завершился)
+                    if (on_partial and time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL
+                            and (partial_task is None or partial_task.done())):
+                        partial = "".join(parts).strip()
+                        if partial:
+                            partial_task = asyncio.create_task(on_partial(partial))
+                        last_edit = time.monotonic()
+        finally:
+            # Последний частичный показ должен завершиться до итогового ответа
+            if partial_task is not None:
+                await asyncio.gather(partial_task, return_exceptions=True)
+        
+        result = "".join(parts).strip()
         logger.info("Ответ от OpenAI получен")
+        breaker_failures = 0
+        gpt_cache[cache_key] = result
+        if vector is not None:
+            semantic_store(user_id, vector, result)
         return result
         
     except Exception as e:
-        logger.error(f"Ошибка OpenAI: {e}")
+        logger.error("Ошибка OpenAI: %s", e)
+        if isinstance(e, RateLimitError) or (isinstance(e, APIStatusError) and e.status_code >= 500):
+            breaker_failures += 1
+            if breaker_failures >= BREAKER_THRESHOLD:
+                breaker_open_until = time.monotonic() + BREAKER_COOLDOWN
+                breaker_failures = 0
+                logger.error("❌ Предохранитель OpenAI сработал на %s сек", BREAKER_COOLDOWN)
         return f"Ошибка обработки через ChatGPT: {e}\n\nИсходный текст: {text}"
 
-def save_to_google_sheet_sync(username, user_id, original_text, processed_text):
-    """Синхронное сохранение в Google таблицу"""
+def result_part(chat_id, text, prefix=""):
+    """Параметры сообщения с частью ответа: часть, разрезанная посреди сущности Markdown, уходит без разметки"""
+    data = {"chat_id": chat_id, "text": prefix + text}
+    if markdown_balanced(text):
+        data["parse_mode"] = "Markdown"
+    return data
+
+async def send_result(chat_id, processed_text, message_id=None):
+    """Отправка итогового ответа: правка processing-сообщения (если есть) и продолжение отдельными сообщениями.
+    Ошибки Telegram API пробрасываются (TelegramError)"""
+    head = split_message(processed_text, RESULT_MAX_BODY)[0]
+    rest = processed_text[len(head):].lstrip("\n")
+    
+    data = result_part(chat_id, head, RESULT_HEADER)
+    if message_id:
+        await telegram_call("editMessageText", {**data, "message_id": message_id})
+    else:
+        await telegram_call("sendMessage", data)
+    
+    # Всё, что не влезло в лимит Telegram, — следующими сообщениями
+    if rest:
+        for part in split_message(rest, TELEGRAM_MAX_MESSAGE):
+            await telegram_call("sendMessage", result_part(chat_id, part))
+
+async def later_command(message, text):
+    """Команда /later — идея уходит в отложенную обработку через Batch API"""
+    chat_id = message['chat']['id']
+    if not text:
+        await send_telegram_message(chat_id, "✍️ Использование: /later <текст идеи>")
+        return
+    
+    user = message.get('from', {})
+    item = {
+        'chat_id': chat_id,
+        'username': user.get('username') or user.get('first_name', 'Unknown'),
+        'user_id': user.get('id'),
+        'text': text
+    }
+    item['custom_id'] = make_custom_id(chat_id, item['user_id'], message.get('message_id'), item['username'])
+    gpt_batch.add(item)
+    await send_telegram_message(chat_id, "🕓 Идея принята. Ответ придёт позже (до 24 часов)")
+
+async def deliver_batch_answer(item, processed_text):
+    """Отправка ответа batch пользователю (False — временная ошибка, повторим позже)"""
+    if processed_text is None:
+        processed_text = f"Ошибка обработки через ChatGPT\n\nИсходный текст: {item['text']}"
+    try:
+        await send_result(item['chat_id'], processed_text)
+    except TelegramError as e:
+        if e.transient:
+            logger.warning("Ответ batch для %s не доставлен, повторим позже: %s", item['custom_id'], e)
+            return False
+        # Бот заблокирован или чат недоступен — повтор не поможет
+        logger.error("Ответ batch для %s не доставлен: %s", item['custom_id'], e)
+        return True
+    
+    await save_to_google_sheet(
+        username=item['username'],
+        user_id=item['user_id'],
+        original_text=item['text'],
+        processed_text=processed_text
+    )
+    return True
+
+async def notify_batch_failure(item):
+    """Сообщение пользователю о неудачной отложенной обработке"""
+    await send_telegram_message(item['chat_id'], "❌ Не удалось обработать отложенную идею")
+
+# Очередь /later (создаётся в lifespan вместе с клиентом OpenAI)
+gpt_batch: GptBatchQueue = None
+
+def create_gpt_batch():
+    """Создание очереди отложенной обработки через OpenAI Batch API"""
+    return GptBatchQueue(
+        openai_client,
+        source=GPT_BATCH_SOURCE,
+        model=GPT_MODEL,
+        system_msg=SYSTEM_MSG,
+        max_tokens=GPT_MAX_TOKENS,
+        deliver=deliver_batch_answer,
+        notify_failure=notify_batch_failure,
+        state_file=GPT_BATCH_STATE_FILE
+    )
+
+async def save_to_google_sheet(username, user_id, original_text, processed_text):
+    """Постановка строки в очередь на запись в Google таблицу"""
+    if not GOOGLE_SCRIPT_URL:
+        logger.info("Google Script URL не настроен")
+        return
+        
+    await sheet_queue.put({
+        'timestamp': format_timestamp(),
+        'username': username,
+        'user_id': user_id,
+        'original_text': original_text,
+        'processed_text': processed_text
+    })
+
+async def send_sheet_batch(rows):
+    """Сохранение пакета строк в Google таблицу одним запросом"""
     try:
-        if not GOOGLE_SCRIPT_URL:
-            logger.info("Google Script URL не настроен")
-            return
-            
         data = {
-            'action': 'saveMessage',
-            'timestamp': datetime.now().strftime('%d.%m.%Y %H:%M:%S'),
-            'username': username,
-            'user_id': user_id,
-            'original_text': original_text,
-            'processed_text': processed_text
+            'action': 'saveMessagesBatch',
+            'rows': rows
         }
         
-        response = requests.post(GOOGLE_SCRIPT_URL, json=data, timeout=10)
+        response = await http_client.post(GOOGLE_SCRIPT_URL, content=orjson.dumps(data), timeout=10)
         
         if response.status_code == 200:
-            logger.info("Данные сохранены в Google таблицу")
+            logger.info("Данные сохранены в Google таблицу: %s строк", len(rows))
         else:
-            logger.error(f"Ошибка сохранения: {response.text}")
+            logger.error("Ошибка сохранения: %s", response.text)
             
     except Exception as e:
-        logger.error(f"Ошибка Google Sheets: {e}")
+        logger.error("Ошибка Google Sheets: %s", e)
 
-def handle_message(update_data):
+def command_reply(update_data):
+    """Тело webhook reply на /start и /help (None для остальных сообщений)"""
+    message = update_data.get('message') or {}
+    tail = COMMAND_REPLY_TAILS.get(message.get('text'))
+    chat_id = message.get('chat', {}).get('id')
+    if tail is None or not isinstance(chat_id, int):
+        return None
+    
+    return b'{"method":"sendMessage","chat_id":%d,' % chat_id + tail
+
+async def handle_message(update_data):
     """Обработка сообщения"""
     try:
         # Простой парсинг JSON без telegram библиотеки
@@ -150,135 +530,207 @@ def handle_message(update_data):
         username = user.get('username') or user.get('first_name', 'Unknown')
         user_id = user.get('id')
         
-        logger.info(f"Получено сообщение от {username}: {text}")
+        logger.info("Получено сообщение от %s: %s", username, text)
         
-        # Команды
-        if text == '/start':
-            response_text = """🤖 *Добро пожаловать в бота для обработки идей!*
-
-Я могу:
-• 💬 Принимать текстовые сообщения  
-• 🧠 Обрабатывать их через ChatGPT
-• 📊 Сохранять результаты
-
-Просто отправьте мне текстовое сообщение!"""
-            
-            send_telegram_message_sync(chat_id, response_text)
-            return
-            
-        elif text == '/help':
-            response_text = """📋 *Как использовать бота:*
-
-1. Отправьте любую идею или задачу
-2. Бот обработает её через ChatGPT  
-3. Получите структурированный ответ
-
-*Команды:*
-• /start - начать работу
-• /help - эта справка"""
-            
-            send_telegram_message_sync(chat_id, response_text)
+        # Отложенная обработка
+        command, _, args = text.partition(' ')
+        if command == '/later':
+            await later_command(message, args.strip())
             return
         
         # Обработка обычного сообщения
         if text and not text.startswith('/'):
-            # Уведомление о начале обработки
-            processing_msg_id = send_telegram_message_sync(
+            # Уведомление о начале обработки отправляем параллельно с запросом к ChatGPT
+            send_task = asyncio.create_task(send_telegram_message(
                 chat_id, 
                 "💭 Обрабатываю через ChatGPT..."
-            )
+            ))
             
+            async def show_partial(partial):
+                """Показ частичного ответа (без Markdown — разметка ещё не закрыта)"""
+                msg_id = await send_task
+                if msg_id:
+                    await edit_telegram_message(chat_id, msg_id, partial, parse_mode=None)
+            
+            # Обработка через ChatGPT
+            processed_text = await process_with_chatgpt(text, user_id, on_partial=show_partial)
+            
+            # Если уведомление не отправилось, результат уйдёт новым сообщением
+            processing_msg_id = await send_task
             if not processing_msg_id:
                 logger.error("Не удалось отправить сообщение о начале обработки")
-                return
             
-            # Обработка через ChatGPT
-            processed_text = process_with_chatgpt_sync(text)
+            # Отправка результата (ошибка отправки не отменяет сохранения в таблицу)
+            try:
+                await send_result(chat_id, processed_text, processing_msg_id)
+            except TelegramError as e:
+                logger.error("Не удалось отправить результат: %s", e)
             
-            # Сохранение в Google таблицу
+            # Сохранение в Google таблицу (уже после ответа пользователю;
+            # сама отправка идёт пакетами в фоновой задаче)
             if GOOGLE_SCRIPT_URL:
-                save_to_google_sheet_sync(
+                await save_to_google_sheet(
                     username=username,
                     user_id=user_id,
                     original_text=text,
                     processed_text=processed_text
                 )
             
-            # Отправка результата
-            result_text = f"""✅ *Сообщение обработано!*
-
-💭 *Обработанная мысль:*
-{processed_text}"""
-            
-            edit_telegram_message_sync(chat_id, processing_msg_id, result_text)
-            
-            logger.info(f"Сообщение обработано для {username}")
+            logger.info("Сообщение обработано для %s", username)
             
     except Exception as e:
-        logger.error(f"Ошибка обработки сообщения: {e}")
+        logger.error("Ошибка обработки сообщения: %s", e)
+
+async def update_worker():
+    """Фоновый воркер: по очереди обрабатывает обновления из work_queue"""
+    while True:
+        update_data = await work_queue.get()
+        try:
+            await handle_message(update_data)
+        finally:
+            work_queue.task_done()
 
-@app.route(f'/webhook/{TELEGRAM_TOKEN}', methods=['POST'])
-def webhook():
+@routes.post(f'/webhook/{TELEGRAM_TOKEN}')
+async def webhook(request):
     """Webhook endpoint"""
     try:
-        json_data = request.get_json()
+        json_data = orjson.loads(await request.read())
         
         if json_data:
-            # Обрабатываем синхронно без event loop
-            handle_message(json_data)
+            update_id = json_data.get('update_id')
+            if update_id is not None:
+                if update_id in seen_updates:
+                    logger.info("Повторная доставка update %s пропущена", update_id)
+                    return json_response({'status': 'ok'}, status=200)
+                seen_updates[update_id] = True
+            
+            # Команды отвечаем прямо в теле ответа webhook — без отдельного запроса к Telegram
+            reply = command_reply(json_data)
+            if reply:
+                return web.Response(body=reply, content_type='application/json')
             
-        return jsonify({'status': 'ok'}), 200
+            try:
+                work_queue.put_nowait(json_data)
+            except asyncio.QueueFull:
+                # Очередь переполнена — Telegram повторит доставку позже
+                logger.warning("Очередь обновлений переполнена")
+                seen_updates.pop(update_id, None)
+                return json_response({'error': 'busy'}, status=503)
+            
+        return json_response({'status': 'ok'}, status=200)
         
     except Exception as e:
-        logger.error(f"Ошибка webhook: {e}")
-        return jsonify({'error': str(e)}), 500
+        logger.error("Ошибка webhook: %s", e)
+        return json_response({'error': str(e)}, status=500)
 
-@app.route('/health', methods=['GET'])
-def health():
+@routes.get('/health')
+async def health(request):
     """Health check"""
-    return jsonify({
+    return json_response({
         'status': 'healthy',
         'bot': 'running',
         'webhook': 'active'
-    }), 200
+    }, status=200)
 
-@app.route('/', methods=['GET'])
-def index():
+@routes.get('/')
+async def index(request):
     """Главная страница"""
-    return jsonify({
+    return json_response({
         'message': 'Telegram Bot is running',
         'status': 'active'
-    }), 200
+    }, status=200)
 
-def setup_webhook():
+async def setup_webhook():
     """Установка webhook"""
     try:
         webhook_url = f"{WEBHOOK_URL}/webhook/{TELEGRAM_TOKEN}"
-        logger.info(f"Устанавливаем webhook: {webhook_url}")
+        logger.info("Устанавливаем webhook: %s", webhook_url)
         
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/setWebhook"
         data = {
             "url": webhook_url,
             "allowed_updates": ["message"]
         }
         
-        response = requests.post(url, json=data, timeout=30)
+        response = await telegram_client.post("/setWebhook", content=orjson.dumps(data))
         
         if response.status_code == 200:
             logger.info("✅ Webhook успешно установлен")
         else:
-            logger.error(f"❌ Не удалось установить webhook: {response.text}")
+            logger.error("❌ Не удалось установить webhook: %s", response.text)
             
     except Exception as e:
-        logger.error(f"Ошибка установки webhook: {e}")
+        logger.error("Ошибка установки webhook: %s", e)
+
+WARMUP_TIMEOUT = 5  # сек
+
+async def warmup_openai():
+    """Прогрев соединения с OpenAI (DNS, TLS), чтобы первый запрос не платил за холодный старт"""
+    try:
+        # Прогрев необязателен: не задерживаем запуск сервера дольше WARMUP_TIMEOUT
+        await asyncio.wait_for(openai_client.models.list(), WARMUP_TIMEOUT)
+        logger.info("✅ Соединение с OpenAI прогрето")
+    except Exception as e:
+        logger.warning("Не удалось прогреть соединение с OpenAI: %r", e)
+
+async def warmup_google_script():
+    """Прогрев соединения с Google Script (и хостом, на который он перенаправляет)"""
+    if not GOOGLE_SCRIPT_URL:
+        return
+    try:
+        await http_client.head(GOOGLE_SCRIPT_URL, timeout=WARMUP_TIMEOUT)
+        logger.info("✅ Соединение с Google Script прогрето")
+    except Exception as e:
+        logger.warning("Не удалось прогреть соединение с Google Script: %s", e)
+
+async def lifespan(app):
+    """Запуск фоновых задач и установка webhook; очистка при остановке"""
+    global http_client, telegram_client, openai_client, gpt_batch
+    http_client = create_http_client()
+    telegram_client = create_telegram_client()
+    openai_client = create_openai_client()
+    gpt_batch = create_gpt_batch()
+    flusher = asyncio.create_task(flush_loop(
+        sheet_queue, send_sheet_batch, SHEET_BATCH_SIZE, SHEET_FLUSH_DELAY
+    )) if GOOGLE_SCRIPT_URL else None
+    workers = [asyncio.create_task(update_worker()) for _ in range(WORKERS)]
+    batcher = asyncio.create_task(gpt_batch.run())
+    # setWebhook заодно прогревает соединение с Telegram
+    await asyncio.gather(setup_webhook(), warmup_openai(), warmup_google_script())
+    
+    yield
+    
+    # Даём воркерам дообработать принятые обновления
+    try:
+        await asyncio.wait_for(work_queue.join(), timeout=10)
+    except asyncio.TimeoutError:
+        logger.warning("Не обработано обновлений: %s", work_queue.qsize())
+    for task in workers + [batcher]:
+        task.cancel()
+    await asyncio.gather(*workers, batcher, return_exceptions=True)
+    
+    # Накопленные /later отправляем сейчас — ответы заберёт следующий запуск
+    await gpt_batch.shutdown()
+    
+    if flusher:
+        # Флашер дошлёт всё, что стоит в очереди перед сигналом остановки
+        await sheet_queue.put(None)
+        await asyncio.gather(flusher, return_exceptions=True)
+    await http_client.aclose()
+    await telegram_client.aclose()
+    await openai_client.close()
+
+app = web.Application()
+app.add_routes(routes)
+app.cleanup_ctx.append(lifespan)
 
 if __name__ == '__main__':
     logger.info("Инициализация webhook бота...")
     
-    # Установка webhook
-    setup_webhook()
+    if uvloop is not None:
+        uvloop.install()
+        logger.info("Используется uvloop")
     
-    # Запуск Flask сервера
+    # Запуск aiohttp сервера (webhook устанавливается при старте)
     port = int(os.environ.get("PORT", 5000))
-    logger.info(f"Запуск Flask сервера на порту {port}")
-    app.run(host="0.0.0.0", port=port, debug=False)
+    logger.info("Запуск aiohttp сервера на порту %s", port)
+    web.run_app(app, host="0.0.0.0", port=port)